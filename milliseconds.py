@@ -1,177 +1,430 @@
 #!/usr/bin/python3
 """Nginx access log analyzer"""
 
+import argparse
+import heapq
 import json
+import math
+import mmap
+import multiprocessing
+import os
 import sys
 import re
 
+from collections import defaultdict
+from operator import itemgetter
 from pprint import pprint
 
 
-def add_counters(data, category):
+class Bucket:
+    """Counters of the requests in one result category"""
 
-    # Set baseline if first value
-    if result[category]['count'] == 0:
-        result[category]['max'] = data['duration']
-        result[category]['min'] = data['duration']
+    __slots__ = ('count', 'min', 'max', 'sum', 'bytes')
 
-    if data['duration'] > result[category]['max']:
-        result[category]['max'] = data['duration']
+    def __init__(self):
+        self.clear()
 
-    if data['duration'] < result[category]['min']:
-        result[category]['min'] = data['duration']
+    def clear(self):
+        self.count = 0
+        # Any duration is smaller than the initial min, and durations can't
+        # be negative, so the first value always sets both min and max
+        self.min = math.inf
+        self.max = 0
+        self.sum = 0
+        self.bytes = 0
 
-    # Increment counters
-    result[category]['count'] += 1
-    result[category]['sum'] += data['duration']
-    result[category]['avg'] = \
-        int(result[category]['sum'] / result[category]['count'])
 
-    result[category]['bytes'] += data['bytes']
+class ErrorReport:
+    """Log lines of one chunk that did not match lineformat
 
-    return result
+    Only the first MAX_ERRORS lines are kept for the parent process to print,
+    the rest are just counted, so a log in the wrong format is not held in
+    memory.
+    """
 
+    __slots__ = ('count', 'lines')
 
-def get_top_10(result_type, result_type_dict):
-    result = dict()
-    for entry in sorted(
-            result_type_dict,
-            key=result_type_dict.__getitem__,
-            reverse=True)[0:9]:
+    def __init__(self):
+        self.count = 0
+        self.lines = []
 
-        result[entry] = result_types[result_type][entry]
+    def add(self, l):
+        self.count += 1
+        if len(self.lines) < MAX_ERRORS:
+            self.lines.append(l)
 
-    return result
 
+def add_counters(duration, nbytes, bucket):
 
-bucket = {
-    'count': 0,
-    'min': 0,
-    'max': 0,
-    'avg': 0,
-    'sum': 0,
-    'bytes': 0,
-    #  '95th_percentile': 0
-}
-result = {
-    'total': dict(bucket),
-    'cache_none': dict(bucket),
-    'cache_hit': dict(bucket),
-    'cache_miss': dict(bucket),
-    'cache_other': dict(bucket),
-    '1xx': dict(bucket),
-    '2xx': dict(bucket),
-    '3xx': dict(bucket),
-    '4xx': dict(bucket),
-    '5xx': dict(bucket),
+    if duration > bucket.max:
+        bucket.max = duration
+
+    if duration < bucket.min:
+        bucket.min = duration
+
+    # Increment counters
+    bucket.count += 1
+    bucket.sum += duration
+
+    bucket.bytes += nbytes
+
+
+def get_top_10(result_type_dict):
+    return dict(heapq.nlargest(10, result_type_dict.items(),
+                               key=itemgetter(1)))
+
+
+def get_cache_category(cache):
+    if '-' in cache or 'BYPASS' in cache:
+        return buckets['cache_none']
+    elif 'HIT' in cache:
+        return buckets['cache_hit']
+    elif 'MISS' in cache:
+        return buckets['cache_miss']
+    else:
+        return buckets['cache_other']
+
+
+def get_status_category(status):
+    # Track 503 status separately from other 5xx responses
+    if status == '503':
+        return buckets['503']
+    else:
+        return buckets[status[0] + 'xx']
+
+
+def get_cpu_count():
+    # Only count the CPUs this process may run on, e.g. in a container
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    else:
+        return os.cpu_count() or 1
+
+
+def get_chunks(path, count):
+    """Split the file into byte ranges that start at the beginning of a line"""
+    size = os.path.getsize(path)
+    # Don't bother splitting small files, a worker needs a bit of work to pay
+    # off its startup cost
+    count = max(1, min(count, size // MIN_CHUNK_SIZE))
+
+    offsets = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, count):
+            f.seek(size * i // count)
+            f.readline()
+            offsets.append(max(f.tell(), offsets[-1]))
+    offsets.append(size)
+
+    return [(path, offsets[i], offsets[i + 1]) for i in range(count)]
+
+
+def print_error(l):
+    print('Unexpected log line contents:', file=sys.stderr)
+    # Show line endings the same way as in text mode
+    pprint(l.decode().replace('\r\n', '\n'), stream=sys.stderr)
+
+
+def reset_counters():
+    # The buckets are cleared in place, as the category caches refer to them
+    for bucket in buckets.values():
+        bucket.clear()
+    for result_type_dict in result_types.values():
+        result_type_dict.clear()
+
+
+def report_mmap_lines(mm, start, end, errors):
+    """Add each line in a byte range of a memory mapped file to errors"""
+    while start < end:
+        stop = mm.find(b'\n', start, end)
+        # The last line of the file might not end in a newline
+        stop = end if stop == -1 else stop + 1
+        errors.add(mm[start:stop])
+        start = stop
+
+
+def find_mmap_lines(mm, start, end, errors):
+    """Yield the matching lines in a byte range of a memory mapped file
+
+    The regex finds all lines in one pass, the text between two matches are
+    lines that did not match. Those are added to errors.
+    """
+    position = start
+
+    for match in find_lines(mm, start, end):
+        if match.start() != position:
+            # On error, just skip this line and continue with the next one
+            # Known issue: eg. invalid request might cause empty $request
+            # in nginx, thus producting empty "" after timestamp. Current
+            # regexp fails with that.
+            # FIXME: Should fix the regexp to cope with known common errors
+            report_mmap_lines(mm, position, match.start(), errors)
+        position = match.end()
+        yield match
+
+    # Lines after the last match did not match either
+    report_mmap_lines(mm, position, end, errors)
+
+
+def find_stream_lines(f, errors):
+    """Yield the matching lines read from a file object one at a time"""
+    for l in f:
+        match = match_line(l)
+        if match:
+            yield match
+        else:
+            errors.add(l)
+
+
+def analyze_lines(matches):
+    """Update the counters with the matched log lines
+
+    Returns the number of lines analyzed.
+    """
+    linecounter = 0
+
+    # Globals used on every line are bound to locals once, as local lookups
+    # are faster in the loop below
+    add = add_counters
+    hostnames = result_types['hostname']
+    remote_addrs = result_types['remote_addr']
+    remote_users = result_types['remote_user']
+    request_types = result_types['request_type']
+    protocols = result_types['protocol']
+    statuses = result_types['status']
+    caches = result_types['cache']
+    cache_category_cache = cache_categories
+    status_category_cache = status_categories
+    total, internal = buckets['total'], buckets['internal']
+    to_int = int
+    to_float = float
+
+    for match in matches:
+        linecounter += 1
+
+        (hostname, remote_addr, remote_user, time, request_type,
+         request_url, protocol, status, nbytes, referer, user_agent,
+         cache, server, duration) = match.groups()
+        status = status.decode()
+        cache = cache.decode()
+        user_agent = user_agent.decode()
+
+        # Collect each unique data type
+        hostnames[hostname.decode()] += 1
+        remote_addrs[remote_addr.decode()] += 1
+        remote_users[remote_user.decode()] += 1
+        request_types[request_type.decode()] += 1
+        protocols[protocol.decode()] += 1
+        statuses[status] += 1
+        caches[cache] += 1
+
+        # Analyze line and update counters
+        # Convert to milliseconds
+        duration = to_int(to_float(duration) * 1000)
+        nbytes = to_int(nbytes)
+        add(duration, nbytes, total)
+
+        cache_category = cache_category_cache.get(cache)
+        if cache_category is None:
+            cache_category = get_cache_category(cache)
+            cache_category_cache[cache] = cache_category
+        add(duration, nbytes, cache_category)
+
+        status_category = status_category_cache.get(status)
+        if status_category is None:
+            status_category = get_status_category(status)
+            status_category_cache[status] = status_category
+        add(duration, nbytes, status_category)
+
+        if 'Zabbix' in user_agent or \
+           'Seravo' in user_agent or \
+           'SWD' in user_agent:
+            add(duration, nbytes, internal)
+
+    return linecounter
+
+
+def analyze_chunk(chunk):
+    """Analyze the log lines in one byte range of the file
+
+    Returns the counters of the chunk and the ErrorReport of the lines that
+    could not be parsed, so the parent process can merge them with the other
+    chunks.
+    """
+    path, start, end = chunk
+    reset_counters()
+    linecounter = 0
+    errors = ErrorReport()
+
+    # Nothing to map, mmap refuses empty files
+    if start == end:
+        return buckets, result_types, linecounter, errors
+
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        linecounter = analyze_lines(find_mmap_lines(mm, start, end, errors))
+
+    return buckets, result_types, linecounter + errors.count, errors
+
+
+def analyze_stream(path):
+    """Analyze all log lines of a file that can only be read sequentially
+
+    Pipes and other special files can't be split into chunks or memory
+    mapped, so they are streamed line by line in a single process. Returns
+    the same results as analyze_chunk().
+    """
+    reset_counters()
+    errors = ErrorReport()
+
+    with open(path, 'rb', buffering=1 << 20) as f:
+        linecounter = analyze_lines(find_stream_lines(f, errors))
+
+    return buckets, result_types, linecounter + errors.count, errors
+
+
+categories = [
+    'total',
+    'cache_none',
+    'cache_hit',
+    'cache_miss',
+    'cache_other',
+    '1xx',
+    '2xx',
+    '3xx',
+    '4xx',
+    '5xx',
     # sites in maintenance mode should not be counted in the 5xx error bucket
-    '503': dict(bucket),
-    'internal': dict(bucket)
-}
+    '503',
+    'internal',
+]
+buckets = {category: Bucket() for category in categories}
 
 result_types = {
-    'hostname': dict(),
-    'remote_addr': dict(),
-    'remote_user': dict(),
-    'request_type': dict(),
-    'protocol': dict(),
-    'status': dict(),
-    'cache': dict(),
+    'hostname': defaultdict(int),
+    'remote_addr': defaultdict(int),
+    'remote_user': defaultdict(int),
+    'request_type': defaultdict(int),
+    'protocol': defaultdict(int),
+    'status': defaultdict(int),
+    'cache': defaultdict(int),
 }
 
+# There are only a handful of distinct cache and HTTP statuses, so classify
+# each of them once and look the category up for the rest of the lines
+cache_categories = dict()
+status_categories = dict()
+
+# The pattern is matched against the whole file, so none of the fields may
+# extend over the end of the line. Matching is done on bytes, only the fields
+# that are compared or counted are decoded. The file is not opened in text
+# mode, so CRLF line endings are accepted explicitly.
 lineformat = (
-    r'(?P<hostname>[^ ]+) '
-    r'(?P<remote_addr>[^ ]+) '
-    r'- '
-    r'(?P<remote_user>[^\[]+) '
-    r'\[(?P<time>.+)\] '
+    rb'^(?P<hostname>[^ \n]+) '
+    rb'(?P<remote_addr>[^ \n]+) '
+    rb'- '
+    rb'(?P<remote_user>[^\[\n]+) '
+    rb'\[(?P<time>.+)\] '
     # Clients can name their methods whatever, e.g. CCM_POST
-    r'"(?P<request_type>[A-Z_-]+) '
-    r'(?P<request_url>[^"]+) '
-    r'(?P<protocol>[^ ]+)" '
-    r'(?P<status>[0-9]+) '
-    r'(?P<bytes>[0-9]+) '
-    r'"(?P<referer>[^"]*)" '
-    r'"(?P<user_agent>[^"]*)" '
-    r'(?P<cache>[A-Z-]+) '
-    r'"(?P<server>[^"]+)" '
-    r'(?P<duration>[0-9\\.]+)\n')
-
-pattern = re.compile(lineformat)  # Compile the regex to fail if it is invalid
-linecounter = 0
+    rb'"(?P<request_type>[A-Z_-]+) '
+    rb'(?P<request_url>[^"\n]+) '
+    rb'(?P<protocol>[^ \n]+)" '
+    rb'(?P<status>[0-9]+) '
+    rb'(?P<bytes>[0-9]+) '
+    rb'"(?P<referer>[^"\n]*)" '
+    rb'"(?P<user_agent>[^"\n]*)" '
+    rb'(?P<cache>[A-Z-]+) '
+    rb'"(?P<server>[^"\n]+)" '
+    rb'(?P<duration>[0-9\\.]+)\r?\n')
+
+# Compile the regex to fail if it is invalid, ^ matches at each line start
+pattern = re.compile(lineformat, re.MULTILINE)
+
+# Bind the compiled matchers once
+find_lines = pattern.finditer
+match_line = pattern.match
+
+# Files smaller than this per worker are analyzed in a single process
+MIN_CHUNK_SIZE = 1 << 24
+
+# Unexpected lines beyond this are only counted, not printed
+MAX_ERRORS = 1000
 
 if __name__ == '__main__':
 
-    # Open input log and interate all lines
-    with open(sys.argv[1], 'r') as f:
-
-        for l in f.readlines():
-            linecounter += 1
-
-            match = pattern.search(l)
-
-            if not match:
-                print('Unexpected log line contents:', file=sys.stderr)
-                pprint(l, stream=sys.stderr)
-                # On error, just skip this line and continue with the next one
-                # Known issue: eg. invalid request might cause empty $request
-                # in nginx, thus producting empty "" after timestamp. Current
-                # regexp fails with that.
-                # FIXME: Should fix the regexp to cope with known common errors
-                continue
-            else:
-                data = match.groupdict()
-
-            if len(data) != 14:
-                print('Unexpected log line length: %d' % len(data),
-                      file=sys.stderr)
-                pprint(l, stream=sys.stderr)
-                sys.exit(1)
-
-            # Collect each unique data type
-            for type in result_types.keys():
-                if data[type] not in result_types[type]:
-                    result_types[type][data[type]] = 1
-                else:
-                    result_types[type][data[type]] += 1
-
-            # Analyze line and update counters
-            if data:
-                # Convert to milliseconds
-                data['duration'] = int(float(data['duration']) * 1000)
-                data['bytes'] = int(data['bytes'])
-                add_counters(data, 'total')
-
-            if '-' in data['cache'] or 'BYPASS' in data['cache']:
-                add_counters(data, 'cache_none')
-            elif 'HIT' in data['cache']:
-                add_counters(data, 'cache_hit')
-            elif 'MISS' in data['cache']:
-                add_counters(data, 'cache_miss')
-            else:
-                add_counters(data, 'cache_other')
-
-            # Track 503 status separately from other 5xx responses
-            if data['status'] == '503':
-                add_counters(data, '503')
-            else:
-                add_counters(data, data['status'][0] + 'xx')
-
-            if 'Zabbix' in data['user_agent'] or \
-               'Seravo' in data['user_agent'] or \
-               'SWD' in data['user_agent']:
-                add_counters(data, 'internal')
-
-        # Extend results with top-10 lists for each result type
-        for result_type in result_types:
-            result['top-' + result_type] = get_top_10(
-                result_type, result_types[result_type])
-
-        # Output results
-        print(json.dumps(result, indent=4))
-
-        # Debug: print log data types
-        debug = False
-        if debug:
-            print('Total lines analyzed: %d' % linecounter)
-            print('Total requests calculated: %d' % result['total']['count'])
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('logfile', help='Nginx access log file to analyze')
+    parser.add_argument('--debug', action='store_true',
+                        help='print line counts after the results')
+    args = parser.parse_args()
+
+    # Analyze regular files in parallel chunks, the counters of each chunk are
+    # merged in the same order as the chunks appear in the file
+    if not os.path.isfile(args.logfile):
+        chunk_results = [analyze_stream(args.logfile)]
+    else:
+        chunks = get_chunks(args.logfile, get_cpu_count())
+        if len(chunks) > 1:
+            with multiprocessing.Pool(len(chunks)) as pool:
+                chunk_results = pool.map(analyze_chunk, chunks, chunksize=1)
+        else:
+            chunk_results = [analyze_chunk(chunks[0])]
+
+    total_buckets = {category: Bucket() for category in categories}
+    total_result_types = {type: defaultdict(int) for type in result_types}
+    linecounter = 0
+    errors_shown = 0
+    errors_total = 0
+
+    for (chunk_buckets, chunk_result_types, chunk_linecounter,
+         errors) in chunk_results:
+
+        # Print the same first MAX_ERRORS lines however the file was split
+        for l in errors.lines[:MAX_ERRORS - errors_shown]:
+            print_error(l)
+            errors_shown += 1
+        errors_total += errors.count
+
+        for category, chunk_bucket in chunk_buckets.items():
+            bucket = total_buckets[category]
+            bucket.min = min(bucket.min, chunk_bucket.min)
+            bucket.max = max(bucket.max, chunk_bucket.max)
+            bucket.count += chunk_bucket.count
+            bucket.sum += chunk_bucket.sum
+            bucket.bytes += chunk_bucket.bytes
+
+        for type, result_type_dict in chunk_result_types.items():
+            for entry, count in result_type_dict.items():
+                total_result_types[type][entry] += count
+
+        linecounter += chunk_linecounter
+
+    if errors_total > errors_shown:
+        print('%d more unexpected log lines not shown' %
+              (errors_total - errors_shown), file=sys.stderr)
+
+    result = dict()
+    for category, bucket in total_buckets.items():
+        # Averages are only calculated once all lines have been counted
+        result[category] = {
+            'count': bucket.count,
+            'min': bucket.min if bucket.count else 0,
+            'max': bucket.max,
+            'avg': int(bucket.sum / bucket.count) if bucket.count else 0,
+            'sum': bucket.sum,
+            'bytes': bucket.bytes,
+            #  '95th_percentile': 0
+        }
+
+    # Extend results with top-10 lists for each result type
+    for result_type in total_result_types:
+        result['top-' + result_type] = get_top_10(
+            total_result_types[result_type])
+
+    # Output results
+    print(json.dumps(result, indent=4))
+
+    # Debug: print log data types
+    if args.debug:
+        print('Total lines analyzed: %d' % linecounter)
+        print('Total requests calculated: %d' % result['total']['count'])